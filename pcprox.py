@@ -28,11 +28,20 @@ configuration files emitted by the CmdpcProx tool.
 
 from __future__ import annotations
 
+import logging
 from math import ceil
-from struct import unpack
-from time import sleep
+import os
+from struct import Struct
+import sys
+from time import monotonic, sleep
 from typing import Iterable, Iterator, Optional, Sequence, Text, Tuple, Union
 
+try:
+    from fcntl import ioctl
+except ImportError:
+    # Not a POSIX platform; the hidraw backend is unavailable.
+    ioctl = None
+
 # https://github.com/trezor/cython-hidapi
 import hid
 
@@ -61,6 +70,11 @@ CONFIG_READ_CMDS = (
 
 NULL_MSG = bytes(8)
 
+_LOG = logging.getLogger(__name__)
+
+# Precompiled message format, so the format string is only parsed once.
+_DEVICE_INFO_STRUCT = Struct('<2xBBxHx')
+
 CONFIG_PARAMS = (
     ('tsIDBitCnts', (
         'iLeadParityBitCnt',
@@ -134,8 +148,30 @@ CONFIG_PARAMS = (
 )
 
 
+# Pre-rendered output lines for configuration dumps: a header per section,
+# and a format template per field, so only the field value itself is
+# formatted on each dump.
+_CONFIG_SECTIONS = tuple(
+    ('/ %s' % section, tuple('%s = %%d' % key for key in keys))
+    for section, keys in CONFIG_PARAMS)
+
+
 def _format_hex(i: bytes) -> Text:
-    return ' '.join(['%02x' % c for c in i])
+    return i.hex(' ')
+
+
+class _field(property):
+    """
+    Property which also records the bit-level layout of a configuration
+    field, so that a parser for the whole configuration can be generated.
+    """
+    kind = None         # type: Text
+    page = None         # type: int
+    pos = None          # type: int
+    first_bit = 0
+    bit_len = 8
+    multiplier = 1
+    bit = 0
 
 
 def _int_field(page: int,
@@ -152,8 +188,10 @@ def _int_field(page: int,
     if first_bit > 0:
         bit_len = min(bit_len, 8 - first_bit)
 
+    offset = (page * 8) + pos
+
     def getter(self) -> int:
-        v = self.pages[page][pos]
+        v = self._buf[offset]
 
         if first_bit > 0:
             v >>= first_bit
@@ -166,44 +204,60 @@ def _int_field(page: int,
 
         return v
 
-    def setter(self, new_val: int):
-        if new_val > max_value or new_val < 0:
-            raise Exception('value must be in range 0..%d' % max_value)
-
-        old_val = 0
-        mask = 0xff
-        new_val //= multiplier
-
-        if first_bit != 0 or bit_len != 8:
-            old_val = self.pages[page][pos]
-
-            # Mask out the bits
-            mask = (((2 ** bit_len) - 1) << first_bit)
-            old_val &= 0xff ^ mask
-
-            new_val <<= first_bit
-
-        new_val &= mask
-
-        new_val |= old_val
-
-        self.pages[page][pos] = new_val
-
-    return property(getter, setter)
+    # Masks are computed once here, so the setter is straight-line code with
+    # no special case for whole-byte fields.
+    bit_mask = (2 ** bit_len) - 1
+    inv_mask = 0xff ^ (bit_mask << first_bit)
+
+    # Most fields have no multiplier, so specialise the setter for that
+    # case rather than dividing by 1 on every assignment.
+    if multiplier == 1:
+        def setter(self, new_val: int):
+            if new_val > max_value or new_val < 0:
+                raise Exception('value must be in range 0..%d' % max_value)
+
+            self._buf[offset] = ((self._buf[offset] & inv_mask) |
+                                 ((new_val & bit_mask) << first_bit))
+    else:
+        def setter(self, new_val: int):
+            if new_val > max_value or new_val < 0:
+                raise Exception('value must be in range 0..%d' % max_value)
+
+            self._buf[offset] = (
+                (self._buf[offset] & inv_mask) |
+                (((new_val // multiplier) & bit_mask) << first_bit))
+
+    prop = _field(getter, setter)
+    prop.kind = 'int'
+    prop.page = page
+    prop.pos = pos
+    prop.first_bit = first_bit
+    prop.bit_len = bit_len
+    prop.multiplier = multiplier
+    return prop
 
 
 def _bool_field(page: int, pos: int, bit: int) -> property:
     """Property definition for boolean fields."""
+    offset = (page * 8) + pos
+
     def getter(self):
-        return ((self.pages[page][pos] >> bit) & 1) > 0
+        # The masked bit is already 0 or 1 (and truthy accordingly), so
+        # there's no need to compare or coerce to bool.
+        return (self._buf[offset] >> bit) & 1
 
     def setter(self, new_val):
         if new_val:
-            self.pages[page][pos] |= 1 << bit
+            self._buf[offset] |= 1 << bit
         else:
-            self.pages[page][pos] &= 0xff ^ (1 << bit)
+            self._buf[offset] &= 0xff ^ (1 << bit)
 
-    return property(getter, setter)
+    prop = _field(getter, setter)
+    prop.kind = 'bool'
+    prop.page = page
+    prop.pos = pos
+    prop.bit = bit
+    return prop
 
 
 def _char_field(page: int, pos: int) -> property:
@@ -225,7 +279,83 @@ def _char_field(page: int, pos: int) -> property:
 
         int_prop.fset(self, new_val[0])
 
-    return property(getter, setter)
+    prop = _field(getter, setter)
+    prop.kind = 'char'
+    prop.page = page
+    prop.pos = pos
+    return prop
+
+
+# hidraw ioctls, from <linux/hidraw.h>. The buffer length is encoded in the
+# size field of the ioctl number.
+def _HIDIOCSFEATURE(length: int) -> int:
+    return 0xc0004806 | (length << 16)
+
+
+def _HIDIOCGFEATURE(length: int) -> int:
+    return 0xc0004807 | (length << 16)
+
+
+class HidrawDevice:
+    """
+    Accesses a HID device through the Linux hidraw interface, exposing the
+    same interface as cython-hidapi's hid.device.
+
+    Feature reports become single ioctls on an open file descriptor, which
+    is much cheaper than a control-transfer round trip through libusb and
+    usbfs. The included udev rules grant access to the pcProx's hidraw node.
+    """
+
+    def __init__(self, path: Text):
+        self._fd = os.open(path, os.O_RDWR)
+
+    def set_nonblocking(self, v: int) -> None:
+        # Feature report ioctls are always synchronous.
+        pass
+
+    def send_feature_report(self, data: bytes) -> None:
+        # As with hidapi, data[0] is the report ID.
+        ioctl(self._fd, _HIDIOCSFEATURE(len(data)), bytes(data))
+
+    def get_feature_report(self, report_id: int, length: int) -> bytes:
+        # Matches hidapi's hid_get_feature_report: the report ID goes in the
+        # first byte, and the raw ioctl buffer is returned.
+        buf = bytearray(length)
+        buf[0] = report_id
+        ret = ioctl(self._fd, _HIDIOCGFEATURE(length), buf)
+        return bytes(buf[:ret])
+
+    def close(self) -> None:
+        os.close(self._fd)
+
+
+def _find_hidraw_device(vendor: int, product: int) -> Optional[Text]:
+    """
+    Finds a hidraw device node for the given USB vendor and product ID.
+
+    Returns the path to the device node, or None if there is no match (or
+    no hidraw support).
+    """
+    try:
+        nodes = sorted(os.listdir('/sys/class/hidraw'))
+    except OSError:
+        return None
+
+    for name in nodes:
+        try:
+            with open('/sys/class/hidraw/%s/device/uevent' % name) as f:
+                for line in f:
+                    # eg: HID_ID=0003:00000C27:00003BFA
+                    if not line.startswith('HID_ID='):
+                        continue
+                    hid_id = line.strip().split(':')
+                    if (int(hid_id[-2], 16) == vendor and
+                            int(hid_id[-1], 16) == product):
+                        return '/dev/' + name
+        except (OSError, ValueError):
+            continue
+
+    return None
 
 
 def open_pcprox(debug: bool = False) -> PcProx:
@@ -233,8 +363,21 @@ def open_pcprox(debug: bool = False) -> PcProx:
   Convenience function to find a pcProx by its vendor and product ID, then
   open a connection to it.
 
-  debug: If True, write packet traces to stdout.
+  On Linux, this talks to the device's hidraw node directly when one is
+  accessible, and falls back to hidapi otherwise.
+
+  debug: If True, enable USB packet traces on the 'pcprox' logger.
   """
+    if sys.platform == 'linux' and ioctl is not None:
+        path = _find_hidraw_device(PCPROX_VENDOR, PCPROX_PRODUCT)
+        if path is not None:
+            try:
+                return PcProx(HidrawDevice(path), debug=debug)
+            except OSError:
+                # eg: EACCES when the bundled udev rules aren't installed,
+                # or EBUSY. Fall back to hidapi, which may still work.
+                pass
+
     dev = hid.device()
     dev.open(PCPROX_VENDOR, PCPROX_PRODUCT)
     return PcProx(dev, debug=debug)
@@ -243,7 +386,8 @@ def open_pcprox(debug: bool = False) -> PcProx:
 class DeviceInfo:
     def __init__(self, msg: bytes):
         # TODO: figure this out device_type better
-        minor_ver, major_ver, self.device_type = unpack('<2xBBxHx', msg)
+        minor_ver, major_ver, self.device_type = _DEVICE_INFO_STRUCT.unpack(
+            msg)
         self.firmware_version_tuple = (
             major_ver, minor_ver >> 4, minor_ver & 0xf)
 
@@ -258,9 +402,25 @@ class DeviceInfo:
 
 class Configuration:
     def __init__(self, pages: Iterable[Optional[bytes]]):
-        self.pages = []
-        for page in pages:
-            self.pages.append(bytearray(page))
+        # All pages are stored in a single flat buffer, 8 bytes per page.
+        self._buf = bytearray(b''.join(pages))
+
+        # Pages as last known to be on the device, seeded with the state the
+        # configuration was read with, and updated by set_config. Pages which
+        # haven't changed since are never re-sent: a full set_config after
+        # touching one page only writes that page.
+        self._last_sent = {
+            i: bytes(self._buf[i * 8:(i + 1) * 8])
+            for i in range(len(self._buf) // 8)}
+
+    @property
+    def pages(self) -> Sequence[memoryview]:
+        """
+        Per-page views of the configuration. Mutating a view mutates the
+        underlying configuration, without copying it.
+        """
+        view = memoryview(self._buf)
+        return [view[i * 8:(i + 1) * 8] for i in range(len(self._buf) // 8)]
 
     # Page 0
     iFACDispLen = _int_field(0, 0)
@@ -326,29 +486,125 @@ class Configuration:
     # TODO: Handle iTrailChrN
 
     def generate_config(self) -> Iterator[Text]:
-        for section, keys in CONFIG_PARAMS:
-            yield '/ %s' % section
-            for key in keys:
-                v = getattr(self, key)
-                if isinstance(v, bytes):
-                    v = v[0]
-                if isinstance(v, bool):
-                    v = int(v)
-
-                yield '%s = %d' % (key, v)
+        values = iter(_config_snapshot(self._buf))
+        for header, templates in _CONFIG_SECTIONS:
+            yield header
+            for template in templates:
+                yield template % next(values)
             yield ''
 
     def print_config(self) -> None:
         for l in self.generate_config():
             print(l)
 
-    def set_config(self, dev: PcProx, pages: Optional[Sequence[int]] = None):
+    def set_config(self, dev: PcProx, pages: Optional[Sequence[int]] = None,
+                   end: bool = False):
+        """
+        Writes configuration pages to the device.
+
+        pages: page numbers to write; defaults to all pages.
+        end: if True, also leave configuration mode (without writing to the
+        EEPROM) in the same batch, instead of a separate end_config call.
+        """
         if pages is None:
             pages = (0, 1, 2)
 
+        # A page select and its payload can't share a message (commands are
+        # exactly 8 bytes, and a page is 8 bytes of data), but all of the
+        # selects and payloads can go out as one batch with a single settle
+        # delay at the end.
+        view = memoryview(self._buf)
+        msgs = []
         for i in pages:
-            dev.write(bytes([0x80 | i]))
-            dev.write(bytes(self.pages[i]))
+            page = view[i * 8:(i + 1) * 8]
+
+            # Skip pages the device already has. Comparing through the
+            # memoryview means unchanged pages aren't copied at all.
+            if self._last_sent.get(i) == page:
+                continue
+
+            page = bytes(page)
+            msgs.append(bytes([0x80 | i]))
+            msgs.append(page)
+            self._last_sent[i] = page
+
+        if not msgs:
+            # Nothing changed, so nothing was selected for writing either;
+            # but still honour a request to leave configuration mode, if an
+            # earlier write left the device in it.
+            if end:
+                dev._ensure_runtime()
+            return
+
+        if end:
+            msgs.append(bytes([0x90, 0]))
+
+        dev.write_batch(msgs)
+        dev._in_config = not end
+
+    def set_led(self, dev: PcProx, red: bool, grn: bool) -> None:
+        """
+        Sets both LED states in a single call, and sends the updated page to
+        the device.
+
+        bAppCtrlsLED must be set for the device to honour these.
+
+        Repeated calls with an unchanged state send no USB traffic at all,
+        so this is cheap to call from a blink loop.
+
+        This leaves the device in configuration mode; reading a tag drops
+        back to normal operation automatically.
+        """
+        self.iRedLEDState = red
+        self.iGrnLEDState = grn
+        self.set_config(dev, [2])
+
+
+def _field_expr(field: _field) -> Text:
+    """
+    Builds a Python expression which reads a single field from `buf`.
+
+    All field kinds are emitted as plain integers: the field kind is known
+    when the expression is built, so the dump path never needs to inspect
+    value types at runtime.
+    """
+    expr = 'buf[%d]' % ((field.page * 8) + field.pos)
+
+    if field.kind == 'bool':
+        return '(%s >> %d) & 1' % (expr, field.bit)
+
+    if field.first_bit > 0:
+        expr = '(%s >> %d)' % (expr, field.first_bit)
+
+    if field.bit_len < 8:
+        expr = '%s & 0x%02x' % (expr, (2 ** field.bit_len) - 1)
+
+    if field.multiplier != 1:
+        expr = '(%s) * %d' % (expr, field.multiplier)
+
+    return expr
+
+
+def _compile_snapshot():
+    """
+    Generates a function which reads every field in CONFIG_PARAMS from the
+    configuration pages in a single pass.
+
+    This avoids dispatching through all of the property descriptors whenever
+    the whole configuration is dumped.
+    """
+    exprs = []
+    for _, keys in CONFIG_PARAMS:
+        for key in keys:
+            exprs.append(_field_expr(Configuration.__dict__[key]))
+
+    src = 'def _config_snapshot(buf):\n    return (%s,)' % ', '.join(exprs)
+    env = {}
+    exec(compile(src, '<pcprox._config_snapshot>', 'exec'), env)
+    return env['_config_snapshot']
+
+
+_config_snapshot = _compile_snapshot()
 
 
 class PcProx:
@@ -357,33 +613,65 @@ class PcProx:
         Opens a connection to a pcProx device.
 
         dev: hidapi device reference to which device to connect to.
-        debug: if True, this library will write USB packets to stdout.
+        debug: if True, enable USB packet traces on the 'pcprox' logger,
+        without the caller needing to configure logging itself.
         """
         self._dev = dev
-        self._debug = debug
+        if debug:
+            logging.basicConfig()
+            _LOG.setLevel(logging.DEBUG)
         self._dev.set_nonblocking(1)
+        self._device_info = None  # type: Optional[DeviceInfo]
+
+        # True when a configuration write has been issued without a
+        # following finish-configuration command.
+        self._in_config = False
+
+        # Scratch buffer for outgoing feature reports: a zero report ID byte
+        # followed by the 8 byte message. Reused across sends, so each send
+        # only materialises one bytes object.
+        self._tx = bytearray(9)
 
     def close(self):
         # TODO
         pass
 
-    def write(self, msg: bytes) -> None:
-        # Sends a message to the device.
+    def _send(self, msg: bytes) -> None:
+        # Sends a message to the device, without waiting for it to settle.
         # This needs to be exactly 8 bytes.
-        msg = bytes(msg)
-        if len(msg) > 8:
+        msg_len = len(msg)
+        if msg_len > 8:
             raise Exception('Can only send up to 8 byte messages.')
 
+        tx = self._tx
+        tx[1:msg_len + 1] = msg
         # Pad short commands with NULL bytes
-        if len(msg) < 8:
-            msg += bytes(8 - len(msg))
+        tx[msg_len + 1:] = bytes(8 - msg_len)
 
-        if self._debug:
-            print('USB TX: >>> ' + _format_hex(msg))
+        if _LOG.isEnabledFor(logging.DEBUG):
+            _LOG.debug('USB TX: >>> %s', _format_hex(bytes(tx[1:])))
 
-        self._dev.send_feature_report(bytes(1) + msg)
+        self._dev.send_feature_report(bytes(tx))
 
         # TODO: handle return code
+
+    def write(self, msg: bytes, settle: bool = True) -> None:
+        # Sends a message to the device.
+        # This needs to be exactly 8 bytes.
+        #
+        # Callers which immediately follow up with another write can pass
+        # settle=False to skip the settle delay.
+        self._send(msg)
+        if settle:
+            sleep(0.001)
+
+    def write_batch(self, msgs: Iterable[bytes]) -> None:
+        """
+        Sends several messages to the device back-to-back, with a single
+        settle delay at the end, rather than one delay per message.
+        """
+        for msg in msgs:
+            self._send(msg)
         sleep(0.001)
 
     def read(self) -> Optional[bytes]:
@@ -400,8 +688,8 @@ class PcProx:
         # Feature reports have a report number added to them, skip that.
         msg = bytes(msg)
 
-        if self._debug:
-            print('USB RX: >>> ' + _format_hex(msg))
+        if _LOG.isEnabledFor(logging.DEBUG):
+            _LOG.debug('USB RX: >>> %s', _format_hex(msg))
 
         if not msg or msg == NULL_MSG:
             return None
@@ -418,19 +706,56 @@ class PcProx:
     def get_device_info(self) -> DeviceInfo:
         """
         Gets device information from the pcProx.
+
+        The firmware version and device type can't change while the device
+        is open, so this is only read from the device once.
         """
-        return DeviceInfo(self.interact(b'\x8a'))
+        if self._device_info is None:
+            self._device_info = DeviceInfo(self.interact(b'\x8a'))
+        return self._device_info
 
     def get_config(self) -> Configuration:
         """
         Gets the running configuration from pcProx.
         """
+        # Page reads must stay strictly serial: 0x80-0x82 are get+put
+        # commands, so a page select followed by another write is a page
+        # *write*, and the device only holds the response to the last
+        # command. Pipelining these would clobber the configuration.
         ret = []
         for page in (0x80, 0x81, 0x82):
             ret.append(self.interact(bytes([page])))
 
         return Configuration(ret)
 
+    def wait_config_applied(self, config: Configuration,
+                            timeout: float = .5,
+                            interval: float = .02) -> bool:
+        """
+        Polls the device until it reports configuration pages matching
+        `config`, or until `timeout` (in seconds) has elapsed.
+
+        Returns True if the device reported the expected configuration.
+
+        Most devices apply a configuration write in well under the timeout,
+        so this typically returns much sooner than a worst-case fixed sleep.
+        """
+        deadline = monotonic() + timeout
+        while True:
+            # Read the raw pages rather than using get_config: a NULL
+            # report (read() maps it to None) is the device's normal "not
+            # ready" signal, so treat it as "not applied yet" and keep
+            # polling, rather than crashing on it.
+            pages = [self.interact(bytes([page]))
+                     for page in (0x80, 0x81, 0x82)]
+
+            if None not in pages and b''.join(pages) == config._buf:
+                return True
+
+            if monotonic() >= deadline:
+                return False
+            sleep(interval)
+
     def save_config(self, pages: int = 0x7) -> None:
         """
         Writes configuration to the EEPROM for all pages.
@@ -439,6 +764,7 @@ class PcProx:
         """
         # defaults to writing all pages
         self.write(bytes([0x90, pages]))
+        self._in_config = False
 
     def end_config(self) -> None:
         """
@@ -446,6 +772,12 @@ class PcProx:
         """
         self.save_config(0)
 
+    def _ensure_runtime(self) -> None:
+        # Leaves configuration mode, if a configuration write left the
+        # device in it.
+        if self._in_config:
+            self.end_config()
+
     def get_tag(self) -> Optional[Tuple[bytes, int]]:
         """
         Reads a single tag, and immediately returns, even if no tag was in the
@@ -456,6 +788,8 @@ class PcProx:
         Returns a tuple of (data, buffer_bits) if there was a tag in the field. See
         `protocol.md` for information about how to interpret this buffer.
         """
+        self._ensure_runtime()
+
         # Must send 8F first, else 8E will never be set!
         card_data = self.interact(b'\x8f')
         if card_data is None:
@@ -466,9 +800,29 @@ class PcProx:
         if card_info is None:
             return None
 
-        bit_length = unpack('<B7x', card_info)[0]
+        bit_length = card_info[0]
 
         # Strip off bytes that aren't needed
         buffer_byte_length = int(ceil(bit_length / 8.))
 
         return card_data[:buffer_byte_length], bit_length
+
+    def wait_for_tag(
+            self, timeout: float) -> Optional[Tuple[bytes, int]]:
+        """
+        Waits for a tag to enter the field, polling frequently, until
+        `timeout` (in seconds) has elapsed.
+
+        The pcProx only exposes card data via feature reports (its interrupt
+        endpoint is the emulated keyboard), so this polls get_tag at a short
+        interval rather than waiting at some longer, fixed cadence.
+
+        Returns the same values as get_tag; None if the timeout elapsed with
+        no tag in the field.
+        """
+        deadline = monotonic() + timeout
+        while True:
+            tag = self.get_tag()
+            if tag is not None or monotonic() >= deadline:
+                return tag
+            sleep(.02)
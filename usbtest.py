@@ -19,19 +19,35 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
+import logging
+
 import pcprox
-from time import sleep
+from time import monotonic, sleep
+
+# One cycle of red LED states while waiting for a card:
+# "1-on 1-off 1-on 3-off".
+_WAIT_PATTERN = (True, False, True, False, False, False)
+_WAIT_FRAME_RATE = 5  # LED frames per second
+
+# (red, green) LED states for the light show after reading a card.
+_SHOW_PATTERN = tuple((x & 0x02 > 0, x & 0x01 == 0) for x in range(20))
 
 
-def main(debug=False):
+def main(debug=False, timeout=8.):
+    logging.basicConfig(
+        level=logging.DEBUG if debug else logging.WARNING)
+
     dev = pcprox.open_pcprox(debug=debug)
 
-    # Show the device info
-    print(repr(dev.get_device_info()))
+    if debug:
+        # Show the device info
+        print(repr(dev.get_device_info()))
 
-    # Dump the configuration from the device.
+    # Read the configuration from the device.
     config = dev.get_config()
-    config.print_config()
+
+    if debug:
+        config.print_config()
 
     # Disable sending keystrokes, as we want direct control
     config.bHaltKBSnd = True
@@ -49,55 +65,53 @@ def main(debug=False):
     # Exit configuration mode
     dev.end_config()
 
-    # Wait half a second
-    sleep(.5)
+    # Wait until the device reports the new configuration, rather than a
+    # fixed worst-case half second. If the readback never matches (eg: on a
+    # device that echoes pages differently), the timeout bounds this at the
+    # half-second settle this replaced.
+    dev.wait_config_applied(config)
 
-    # Turn off the green LED
-    config.iGrnLEDState = False
     found_card = False
     print('Waiting for a card... (red light should pulse)')
-    for x in range(40):
-        # flash the red LED as "1-on 1-off 1-on 3-off"
-        config.iRedLEDState = (x % 6 in (0, 2))
-        # LED control is in page 2, so we can explicitly only configure this
-        # page.
-        config.set_config(dev, [2])
-        dev.end_config()
-        tag = dev.get_tag()
-
-        if tag is not None:
-            # We got a card!
-            # Turn off the red LED
-            config.iRedLEDState = False
-            config.set_config(dev, [2])
-            dev.end_config()
-            found_card = True
-
-            # Print the tag ID on screen
-            print('Tag data: %s' % pcprox._format_hex(tag[0]))
-            print('Bit length: %d' % tag[1])
-            break
-
-        # No card in the field, sleep
-        sleep(.2)
+    # The scan runs until `deadline`, independently of the LED frame rate:
+    # the LED frame is picked by elapsed time, and frames are scheduled
+    # against a monotonic deadline so the time spent on USB I/O doesn't skew
+    # the blink cadence.
+    tag = None
+    start = next_frame = monotonic()
+    deadline = start + timeout
+    while tag is None and monotonic() < deadline:
+        frame = int((monotonic() - start) * _WAIT_FRAME_RATE)
+        config.set_led(dev, _WAIT_PATTERN[frame % len(_WAIT_PATTERN)], False)
+        # Poll for a card until the next LED frame (or the scan deadline) is
+        # due.
+        next_frame += 1. / _WAIT_FRAME_RATE
+        tag = dev.wait_for_tag(
+            max(0, min(next_frame, deadline) - monotonic()))
+
+    if tag is not None:
+        # We got a card!
+        # Turn off the red LED and show green, in one page write.
+        config.set_led(dev, False, True)
+        found_card = True
+
+        # Print the tag ID on screen
+        print('Tag data: %s' % pcprox._format_hex(tag[0]))
+        print('Bit length: %d' % tag[1])
 
     # We were successful, do a little light show
     if found_card:
         print('We got a card! (blinking lights)')
-        for x in range(20):
-            config.iGrnLEDState = x & 0x01 == 0
-            config.iRedLEDState = x & 0x02 > 0
-            config.set_config(dev, [2])
-            dev.end_config()
-            sleep(.1)
+        next_frame = monotonic()
+        for red, grn in _SHOW_PATTERN:
+            config.set_led(dev, red, grn)
+            next_frame += .1
+            sleep(max(0, next_frame - monotonic()))
     else:
         # When wrapping up, wait 0.3sec, so we get to see the green light on
         # success.
         print('No card found.')
 
-    # Re-enable sending keystrokes
-    config.bHaltKBSnd = True
-
     # Place the LEDs back under pcProx control
     config.iRedLEDState = config.iGrnLEDState = config.bAppCtrlsLED = False
 
@@ -108,7 +122,9 @@ def main(debug=False):
     # Done.
 
 
-if __name__ == '__main__':
+def _parse_args():
+    # argparse is only imported (and the parser only built) when running as
+    # a script; importing this module stays cheap.
     import argparse
     parser = argparse.ArgumentParser(
         description='Test program for pcprox which reads a card in the field')
@@ -116,5 +132,13 @@ if __name__ == '__main__':
     parser.add_argument('-d', '--debug', action='store_true',
                         help='Enable debug traces')
 
-    options = parser.parse_args()
-    main(options.debug)
+    parser.add_argument('-t', '--timeout', type=float, default=8.,
+                        help='How long to wait for a card, in seconds '
+                             '(default: %(default)s)')
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    options = _parse_args()
+    main(options.debug, options.timeout)